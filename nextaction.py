@@ -5,9 +5,16 @@ import argparse
 
 # noinspection PyPackageRequirements
 from todoist.api import TodoistAPI
+# noinspection PyPackageRequirements
+from todoist.models import Model
 
+import copy
+import os
+import re
+import signal
 import time
 import sys
+from collections import OrderedDict, namedtuple
 from datetime import datetime
 
 
@@ -33,29 +40,325 @@ class Item(object):
                                                self.labels)
 
 
+def check_regex(value):
+    """
+    argparse type checking a regular expression compiles
+    """
+    try:
+        re.compile(value)
+    except re.error as exc:
+        raise argparse.ArgumentTypeError(
+            'invalid regular expression {!r}: {}'.format(value, exc))
+    return value
+
+
+class TypeClassifier(object):
+    """
+    Resolves the processing type from a project or item name
+
+    Every marker is compiled once on its own, so inline flags and
+    backreferences in user regexes keep working. The resolved type is cached
+    per id, so a name is only inspected again once it changes.
+    """
+    TYPES = ('parallel', 'serial')
+
+    def __init__(self, markers):
+        """
+        markers is a list of (type, regex) tuples in order of priority
+        """
+        self.markers = [(marker_type, re.compile(regex))
+                        for marker_type, regex in markers]
+        self.cache = {}
+        # keys classified since the last prune
+        self.seen = set()
+
+    @classmethod
+    def from_args(cls, args):
+        """
+        Builds the classifier from the suffix, prefix and regex arguments
+        """
+        markers = []
+        for marker_type in cls.TYPES:
+            suffix = getattr(args, marker_type + '_suffix')
+            prefix = getattr(args, marker_type + '_prefix')
+            regex = getattr(args, marker_type + '_regex')
+            if suffix:
+                markers.append((marker_type, re.escape(suffix) + '$'))
+            if prefix:
+                markers.append((marker_type, '^' + re.escape(prefix)))
+            if regex:
+                markers.append((marker_type, regex))
+        return cls(markers)
+
+    def match(self, name):
+        """
+        Returns the type the name is marked with, None if not marked
+        """
+        name = name.strip()
+        for marker_type, pattern in self.markers:
+            if pattern.search(name):
+                return marker_type
+
+    def classify(self, key, name):
+        """
+        Returns the cached type for key, refreshing it when the name changed
+        """
+        self.seen.add(key)
+        cached = self.cache.get(key)
+        if cached is not None and cached[0] == name:
+            return cached[1]
+        marker_type = self.match(name)
+        self.cache[key] = (name, marker_type)
+        return marker_type
+
+    def prune(self):
+        """
+        Drop cached types of everything not classified since the last prune
+        """
+        self.cache = dict((key, self.cache[key]) for key in self.seen
+                          if key in self.cache)
+        self.seen = set()
+
+
+class SnapshotItems(object):
+    """
+    Offline item manager replaying a snapshot of the synced items
+
+    Label updates are recorded instead of being queued for sync.
+    """
+    def __init__(self, items):
+        self.state = copy.deepcopy(items)
+        self.updates = OrderedDict()
+
+    def all(self, filt=None):
+        return [item for item in self.state if filt is None or filt(item)]
+
+    def update(self, item_id, **kwargs):
+        self.updates[item_id] = list(kwargs['labels'])
+
+
+class SnapshotAPI(object):
+    def __init__(self, items):
+        self.items = SnapshotItems(items)
+
+
+def item_path(projects, items, item_id):
+    """
+    Describe where an item lives as project and parent item names
+    """
+    item = [x for x in items if x['id'] == item_id][0]
+    path = [project['name'] for project in projects
+            if project['id'] == item['project_id']]
+    siblings = sorted([x for x in items
+                       if x['project_id'] == item['project_id']],
+                      key=lambda x: x['item_order'])
+    parents = []
+    for sibling in siblings:
+        while parents and parents[-1]['indent'] >= sibling['indent']:
+            parents.pop()
+        if sibling['id'] == item_id:
+            break
+        parents.append(sibling)
+    path.extend(parent['content'] for parent in parents)
+    path.append(item['content'])
+    return ' / '.join(path)
+
+
+Mismatch = namedtuple('Mismatch', 'engine item_id path expected actual')
+
+
+class ShadowRunner(object):
+    """
+    Runs alternative engines next to the reference on the same snapshot
+
+    Only the reference result is committed, the engines' results are
+    compared against it and every differing item is recorded.
+    """
+    def __init__(self, reference, engines, clean_cycles):
+        self.reference = reference
+        self.clean_cycles = clean_cycles
+        self.engines = OrderedDict((name, ENGINES[name]()) for name in engines)
+        self.stats = dict((name, {'cycles': 0, 'clean': 0, 'time': 0.0,
+                                  'reference_time': 0.0})
+                          for name in engines)
+        self.mismatches = []
+
+    def configure(self, engine):
+        """
+        Share the reference configuration with an engine
+        """
+        engine.args = self.reference.args
+        engine.next_label_id = self.reference.next_label_id
+        engine.active_label_id = self.reference.active_label_id
+        engine.waitfor_label_id = self.reference.waitfor_label_id
+
+    @staticmethod
+    def evaluate(engine, projects, items):
+        """
+        Run engine on the snapshot, returns its label updates and run time
+        """
+        api = SnapshotAPI(items)
+        original_api, engine.api = engine.api, api
+        start = time.time()
+        try:
+            engine.process(list(projects))
+        finally:
+            engine.api = original_api
+        return api.items.updates, time.time() - start
+
+    def run(self, projects, items):
+        """
+        Process projects by the reference and shadow all engines
+        """
+        items = [item.data if isinstance(item, Model) else item
+                 for item in items]
+        updates, reference_time = self.evaluate(self.reference, projects,
+                                                items)
+        for item_id, labels in updates.items():
+            self.reference.api.items.update(item_id, labels=labels)
+
+        self.mismatches = []
+        for name, engine in self.engines.items():
+            stats = self.stats[name]
+            stats['cycles'] += 1
+            self.configure(engine)
+            try:
+                engine_updates, engine_time = self.evaluate(engine, projects,
+                                                            items)
+            except Exception as exc:
+                logging.exception('Shadow engine %s failed: %s', name, exc)
+                stats['clean'] = 0
+                continue
+
+            stats['time'] += engine_time
+            stats['reference_time'] += reference_time
+            logging.debug('Shadow engine %s took %.3fs, reference %.3fs',
+                          name, engine_time, reference_time)
+
+            mismatches = self.compare(name, projects, items, updates,
+                                      engine_updates)
+            for mismatch in mismatches:
+                logging.warning('Shadow engine %s mismatch on %s (%s): '
+                                'expected labels %s, got %s', name,
+                                mismatch.item_id, mismatch.path,
+                                mismatch.expected, mismatch.actual)
+            self.mismatches.extend(mismatches)
+
+            if mismatches:
+                stats['clean'] = 0
+                continue
+            stats['clean'] += 1
+            if stats['clean'] == self.clean_cycles:
+                logging.info('Shadow engine %s ran clean for %d cycles '
+                             'at %.0f%% of the reference time', name,
+                             stats['clean'], self.relative_time(name) * 100)
+
+    def relative_time(self, name):
+        """
+        Engine run time relative to the reference over all cycles
+        """
+        stats = self.stats[name]
+        if not stats['reference_time']:
+            return 0.0
+        return stats['time'] / stats['reference_time']
+
+    @staticmethod
+    def compare(name, projects, items, expected, actual):
+        """
+        List items whose resulting labels differ between two runs
+        """
+        labels = dict((item['id'], item['labels']) for item in items)
+        mismatches = []
+        for item_id in labels:
+            if item_id not in expected and item_id not in actual:
+                continue
+            expected_labels = expected.get(item_id, labels[item_id])
+            actual_labels = actual.get(item_id, labels[item_id])
+            if set(expected_labels) != set(actual_labels):
+                mismatches.append(Mismatch(
+                    name, item_id, item_path(projects, items, item_id),
+                    sorted(expected_labels), sorted(actual_labels)))
+        return mismatches
+
+
 class NextAction(object):
     def __init__(self):
         self.args = None
         self.api = None
+        self.shadow = None
+        self._classifier = None
         self.next_label_id = None
         self.waitfor_label_id = None
         self.active_label_id = None
+        self.argv = sys.argv[1:]
+        self.config_mtimes = {}
+        self.reload_requested = False
+        # live label name -> id index and its reverse
+        self.label_ids = {}
+        self.label_names = {}
 
     def main(self):
         self.setup()
         self.loop()
 
-    def check_label(self, label):
-        # Check if the label exists
-        labels = self.api.labels.all(lambda x: x['name'] == label)
-        if len(labels) > 0:
-            label_id = labels[0]['id']
+    def update_labels(self, labels):
+        """
+        Apply synced label changes to the label index
+        """
+        for label in labels:
+            old_name = self.label_names.pop(label['id'], None)
+            if self.label_ids.get(old_name) == label['id']:
+                del self.label_ids[old_name]
+            if 'is_deleted' in label and label['is_deleted']:
+                continue
+            self.label_ids[label['name']] = label['id']
+            self.label_names[label['id']] = label['name']
+
+        for attr, name in self.managed_labels():
+            label_id = getattr(self, attr)
+            if label_id is not None and label_id not in self.label_names:
+                logging.warning('Label %s was deleted', name)
+                setattr(self, attr, None)
+
+    def managed_labels(self):
+        """
+        Attributes holding the managed label ids and their configured names
+        """
+        return (('next_label_id', self.args.label),
+                ('active_label_id', self.args.active),
+                ('waitfor_label_id', self.args.waitfor))
+
+    def resolve_labels(self):
+        """
+        Look up deleted managed labels again, returns if all of them exist
+        """
+        for attr, name in self.managed_labels():
+            if getattr(self, attr) is None:
+                setattr(self, attr, self.find_label(name))
+        return None not in [getattr(self, attr)
+                            for attr, _ in self.managed_labels()]
+
+    def find_label(self, label):
+        """
+        Look up the label id, creating the label if requested
+        """
+        label_id = self.label_ids.get(label)
+        if label_id is not None:
             logging.debug('Label %s found as label id %d', label, label_id)
             return label_id
-        else:
-            logging.error(
-                "Label %s doesn't exist.", label)
+        if self.args.create_labels:
+            logging.info('Creating label %s', label)
+            new_label = self.api.labels.add(label)
+            self.update_labels(self.api.commit().get('labels', []))
+            return new_label['id']
+        logging.error("Label %s doesn't exist.", label)
+
+    def check_label(self, label):
+        # Check if the label exists
+        label_id = self.find_label(label)
+        if label_id is None:
             sys.exit(1)
+        return label_id
 
     def setup(self):
         self.parse_args()
@@ -65,47 +368,164 @@ class NextAction(object):
         self.api = TodoistAPI(token=self.args.api_key)
         logging.debug('Syncing the current state from the API')
         self.api.sync()
+        self.update_labels(self.api.labels.all())
         self.next_label_id = self.check_label(self.args.label)
         self.active_label_id = self.check_label(self.args.active)
         self.waitfor_label_id = self.check_label(self.args.waitfor)
+        if self.args.shadow:
+            self.shadow = ShadowRunner(self, self.args.shadow,
+                                       self.args.shadow_cycles)
+
+        self.config_mtimes = self.get_config_mtimes()
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self.request_reload)
+
+    def request_reload(self, signum=None, frame=None):
+        """
+        Signal handler, the reload itself is left to the main loop
+        """
+        self.reload_requested = True
+
+    def get_config_mtimes(self):
+        """
+        Modification times of the @file arguments
+        """
+        mtimes = {}
+        for arg in self.argv:
+            if arg.startswith('@'):
+                try:
+                    mtimes[arg[1:]] = os.path.getmtime(arg[1:])
+                except OSError:
+                    mtimes[arg[1:]] = None
+        return mtimes
+
+    def reload(self):
+        """
+        Re-read the configuration keeping the synced state and caches
+        """
+        self.reload_requested = False
+        self.config_mtimes = self.get_config_mtimes()
+        logging.info('Reloading configuration')
+        try:
+            args = self.read_args()
+            classifier = TypeClassifier.from_args(args)
+        except SystemExit:
+            logging.error('Invalid configuration, keeping the current one')
+            return
+        except re.error as exc:
+            logging.error('Invalid marker %s, keeping the current '
+                          'configuration', exc)
+            return
+
+        old_args, self.args = self.args, args
+        label_ids = [self.find_label(name)
+                     for name in (args.label, args.active, args.waitfor)]
+        if None in label_ids:
+            logging.error('Missing labels, keeping the current configuration')
+            self.args = old_args
+            return
+
+        if args.api_key != old_args.api_key:
+            logging.warning('API key change requires a restart, ignoring')
+            args.api_key = old_args.api_key
+        self.set_log_level()
+
+        # items keep the labels of the previous configuration otherwise
+        for old_id, new_id in ((self.next_label_id, label_ids[0]),
+                               (self.active_label_id, label_ids[1])):
+            if old_id is not None and old_id != new_id:
+                self.retire_label(old_id)
+        self.next_label_id, self.active_label_id, self.waitfor_label_id = \
+            label_ids
+
+        markers = ['{}_{}'.format(marker_type, kind)
+                   for marker_type in TypeClassifier.TYPES
+                   for kind in ('suffix', 'prefix', 'regex')]
+        if any(getattr(args, marker) != getattr(old_args, marker)
+               for marker in markers):
+            self._classifier = classifier
+            if self.shadow:
+                for engine in self.shadow.engines.values():
+                    engine._classifier = TypeClassifier.from_args(args)
+
+        if (args.shadow, args.shadow_cycles) != \
+                (old_args.shadow, old_args.shadow_cycles):
+            self.shadow = ShadowRunner(self, args.shadow,
+                                       args.shadow_cycles) \
+                if args.shadow else None
+
+    def retire_label(self, label_id):
+        """
+        Remove a label no longer managed from all items
+        """
+        for item in self.api.items.all(lambda x: label_id in x['labels']):
+            logging.debug('Updating %s without label %s', item['content'],
+                          label_id)
+            # update queues the command only, keep the local state in step
+            labels = item['labels']
+            labels.remove(label_id)
+            self.api.items.update(item['id'], labels=labels)
 
     def loop(self):
         """
         Main loop
         """
         while True:
+            if self.reload_requested or \
+                    self.get_config_mtimes() != self.config_mtimes:
+                self.reload()
             try:
-                self.api.sync()
+                self.update_labels(self.api.sync().get('labels', []))
             except Exception as exc:
                 logging.exception('Error trying to sync with Todoist API: %s',
                                   exc)
             else:
-                self.process(self.api.projects.all())
+                if not self.resolve_labels():
+                    logging.error('Skipping the update until the labels exist')
+                elif self.shadow:
+                    self.shadow.run(self.api.projects.all(),
+                                    self.api.items.all())
+                else:
+                    self.process(self.api.projects.all())
 
                 logging.debug(
                     '%d changes queued for sync... committing if needed',
                     len(self.api.queue))
                 if len(self.api.queue):
-                    self.api.commit()
+                    self.update_labels(self.api.commit().get('labels', []))
 
             if self.args.onetime:
                 break
             logging.debug('Sleeping for %d seconds', self.args.delay)
             time.sleep(self.args.delay)
 
-    def process(self, projects, parent_indent=0, parent_type=None):
+    @property
+    def classifier(self):
+        if self._classifier is None:
+            self._classifier = TypeClassifier.from_args(self.args)
+        return self._classifier
+
+    def resolve_project_types(self, projects):
         """
-        Process all projects
+        Resolve the type of every project including the inherited ones
         """
-        current_type = parent_type
-        while projects and parent_indent < projects[0]["indent"]:
-            # dig deeper
-            if projects[0]["indent"] > parent_indent + 1:
-                self.process(projects, parent_indent + 1, current_type)
-                continue
-
-            project = projects.pop(0)
+        resolved = []
+        # (indent, type) of the current chain of parent projects
+        parents = []
+        for project in projects:
+            while parents and parents[-1][0] >= project["indent"]:
+                parents.pop()
+            parent_type = parents[-1][1] if parents else None
             current_type = self.get_project_type(project, parent_type)
+            parents.append((project["indent"], current_type))
+            resolved.append((project, current_type))
+        return resolved
+
+    def process(self, projects):
+        """
+        Process all projects
+        """
+        for project, current_type in self.resolve_project_types(projects):
             if not current_type:
                 # project not marked - not touching
                 continue
@@ -123,6 +543,8 @@ class NextAction(object):
                 item_objs.append(Item(items))
             self.process_items(item_objs, current_type)
             self.activate(item_objs)
+        # forget completed, deleted and no longer processed items
+        self.classifier.prune()
 
     def process_items(self, items, parent_type, not_in_first=False):
         """
@@ -207,13 +629,14 @@ class NextAction(object):
         """
         Identifies how a project should be handled
         """
-        name = project_object['name'].strip()
-        if name == 'Inbox':
+        if 'inbox_project' in project_object and \
+                project_object['inbox_project'] or \
+                project_object['name'].strip() == 'Inbox':
             return self.args.inbox
-        elif name[-1] == self.args.parallel_suffix:
-            return 'parallel'
-        elif name[-1] == self.args.serial_suffix:
-            return 'serial'
+        project_type = self.classifier.classify(
+            ('project', project_object['id']), project_object['name'])
+        if project_type:
+            return project_type
         elif parent_type:
             return parent_type
 
@@ -221,11 +644,7 @@ class NextAction(object):
         """
         Identifies how a item with sub items should be handled
         """
-        name = item.content.strip()
-        if name[-1] == self.args.parallel_suffix:
-            return 'parallel'
-        elif name[-1] == self.args.serial_suffix:
-            return 'serial'
+        return self.classifier.classify(('item', item.id), item.content)
 
     def add_label(self, item, label):
         if label not in item.labels:
@@ -272,11 +691,11 @@ class NextAction(object):
                 result_items.append(item)
         return result_items
 
-    def parse_args(self):
+    def read_args(self):
         """
-        Parse command-line arguments
+        Read the arguments, arguments can be stored in files passed as @file
         """
-        parser = argparse.ArgumentParser()
+        parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
         parser.add_argument('-a', '--api_key', help='Todoist API Key')
         parser.add_argument('-l', '--label',
                             help='The next action label to use',
@@ -298,20 +717,48 @@ class NextAction(object):
                             default='parallel', choices=['parallel', 'serial'])
         parser.add_argument('--parallel_suffix', default='.')
         parser.add_argument('--serial_suffix', default='_')
+        parser.add_argument('--parallel_prefix',
+                            help='Mark parallel lists by a name prefix')
+        parser.add_argument('--serial_prefix',
+                            help='Mark serial lists by a name prefix')
+        parser.add_argument('--parallel_regex', type=check_regex,
+                            help='Mark parallel lists by a regular expression')
+        parser.add_argument('--serial_regex', type=check_regex,
+                            help='Mark serial lists by a regular expression')
         parser.add_argument('--hide_future',
                             help='Hide future dated next actions until the '
                                  'specified number of days',
                             default=7, type=int)
         parser.add_argument('--onetime', help='Update Todoist once and exit',
                             action='store_true')
-        self.args = parser.parse_args()
+        parser.add_argument('--shadow',
+                            help='Check an alternative engine against the '
+                                 'reference without committing its result',
+                            action='append', choices=sorted(ENGINES))
+        parser.add_argument('--shadow_cycles',
+                            help='Report a shadow engine after it ran clean '
+                                 'for the specified number of cycles',
+                            default=100, type=int)
+        parser.add_argument('--create_labels',
+                            help='Create the labels if they are missing',
+                            action='store_true')
+        return parser.parse_args(self.argv)
 
+    def set_log_level(self):
         # Set debug
         if self.args.debug:
             log_level = logging.DEBUG
         else:
             log_level = logging.INFO
         logging.basicConfig(level=log_level)
+        logging.getLogger().setLevel(log_level)
+
+    def parse_args(self):
+        """
+        Parse command-line arguments
+        """
+        self.args = self.read_args()
+        self.set_log_level()
 
         # Check we have a API key
         if not self.args.api_key:
@@ -319,5 +766,11 @@ class NextAction(object):
             sys.exit(1)
 
 
+# Evaluation engines available for --shadow
+ENGINES = {
+    'reference': NextAction,
+}
+
+
 if __name__ == '__main__':
     NextAction().main()
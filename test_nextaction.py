@@ -1,18 +1,32 @@
 #!/usr/bin/env python
+import argparse
 import unittest
 import datetime
-from mock import Mock, call
-from nextaction import NextAction, Item
+from mock import Mock, call, patch
+from nextaction import NextAction, Item, TypeClassifier, ShadowRunner, \
+    check_regex
+
+
+def make_args():
+    """
+    Mock arguments with the markers used throughout the tests
+    """
+    args = Mock()
+    args.parallel_suffix = ":"
+    args.serial_suffix = "."
+    args.parallel_prefix = None
+    args.serial_prefix = None
+    args.parallel_regex = None
+    args.serial_regex = None
+    return args
 
 
 class TestProjects(unittest.TestCase):
     def setUp(self):
         self.na = NextAction()
         self.na.api = Mock()
-        self.na.args = Mock()
+        self.na.args = make_args()
         self.na.api.items.all.return_value = []
-        self.na.args.parallel_suffix = ":"
-        self.na.args.serial_suffix = "."
 
     def test_ignore_not_marked_empty(self):
         """
@@ -25,8 +39,8 @@ class TestProjects(unittest.TestCase):
         """
         Not marked projects are ignored
         """
-        project1 = {"name": "project1.", "indent": 1}
-        project2 = {"name": "project2", "indent": 1}
+        project1 = {"name": "project1.", "indent": 1, "id": 1}
+        project2 = {"name": "project2", "indent": 1, "id": 2}
         self.na.process_items = Mock()
         self.na.api.projects.all.return_value = [project1, project2]
         self.na.process(self.na.api.projects.all())
@@ -36,10 +50,10 @@ class TestProjects(unittest.TestCase):
         """
         Inherit project type from parent
         """
-        project1 = {"name": "project1.", "indent": 1}
-        project2 = {"name": "project2", "indent": 2}
-        project3 = {"name": "project3:", "indent": 2}
-        project4 = {"name": "project4:", "indent": 1}
+        project1 = {"name": "project1.", "indent": 1, "id": 1}
+        project2 = {"name": "project2", "indent": 2, "id": 2}
+        project3 = {"name": "project3:", "indent": 2, "id": 3}
+        project4 = {"name": "project4:", "indent": 1, "id": 4}
         self.na.process_items = Mock()
         self.na.api.projects.all.return_value = [project1, project2, project3,
                                                  project4]
@@ -48,6 +62,117 @@ class TestProjects(unittest.TestCase):
                  call([], "parallel"), call([], "parallel")]
         self.assertListEqual(self.na.process_items.call_args_list, calls)
 
+    def test_inbox(self):
+        """
+        Inbox is processed as configured
+        """
+        project1 = {"name": "Inbox", "indent": 1, "id": 1}
+        project2 = {"name": "Todo", "indent": 1, "id": 2,
+                    "inbox_project": True}
+        self.na.args.inbox = "parallel"
+        self.na.process_items = Mock()
+        self.na.process([project1, project2])
+        calls = [call([], "parallel"), call([], "parallel")]
+        self.assertListEqual(self.na.process_items.call_args_list, calls)
+
+    def test_inherit_type_skip_level(self):
+        """
+        Inherit project type from the nearest parent
+        """
+        project1 = {"name": "project1:", "indent": 1, "id": 1}
+        project2 = {"name": "project2", "indent": 3, "id": 2}
+        project3 = {"name": "project3", "indent": 2, "id": 3}
+        project4 = {"name": "project4", "indent": 1, "id": 4}
+        project5 = {"name": "project5", "indent": 2, "id": 5}
+        resolved = self.na.resolve_project_types([project1, project2,
+                                                  project3, project4,
+                                                  project5])
+        self.assertListEqual([t for _, t in resolved],
+                             ["parallel", "parallel", "parallel", None, None])
+
+
+class TestClassifier(unittest.TestCase):
+    def test_suffix(self):
+        """
+        Multi-character suffixes are matched
+        """
+        classifier = TypeClassifier([("parallel", "\\.\\.$"),
+                                     ("serial", "_$")])
+        self.assertEqual(classifier.match("project.."), "parallel")
+        self.assertEqual(classifier.match("project_ "), "serial")
+        self.assertEqual(classifier.match("project."), None)
+        self.assertEqual(classifier.match(""), None)
+
+    def test_priority(self):
+        """
+        The first matching marker wins
+        """
+        classifier = TypeClassifier([("parallel", "\\.$"),
+                                     ("serial", "^#"),
+                                     ("serial", "\\[s\\]")])
+        self.assertEqual(classifier.match("#project."), "parallel")
+        self.assertEqual(classifier.match("#project"), "serial")
+        self.assertEqual(classifier.match("project [s] x"), "serial")
+        self.assertEqual(classifier.match("a#project"), None)
+
+    def test_regex(self):
+        """
+        User regexes keep their flags and backreferences
+        """
+        classifier = TypeClassifier([("parallel", "(a)\\1$"),
+                                     ("serial", "(?i)seq"),
+                                     ("serial", "(?P<m0>x)$")])
+        self.assertEqual(classifier.match("project aa"), "parallel")
+        self.assertEqual(classifier.match("SEQ project"), "serial")
+        self.assertEqual(classifier.match("project x"), "serial")
+        self.assertEqual(classifier.match("project a"), None)
+
+    def test_invalid_regex(self):
+        """
+        Invalid regexes are rejected when parsing the arguments
+        """
+        self.assertEqual(check_regex("(a)"), "(a)")
+        self.assertRaises(argparse.ArgumentTypeError, check_regex, "(")
+
+    def test_from_args(self):
+        """
+        Markers are built from the arguments
+        """
+        args = Mock(parallel_suffix="..", serial_suffix=None,
+                    parallel_prefix=None, serial_prefix="+",
+                    parallel_regex=None, serial_regex="\\(seq\\)")
+        classifier = TypeClassifier.from_args(args)
+        self.assertEqual(classifier.match("project.."), "parallel")
+        self.assertEqual(classifier.match("+project"), "serial")
+        self.assertEqual(classifier.match("project (seq)"), "serial")
+        self.assertEqual(classifier.match("project_"), None)
+
+    def test_cache(self):
+        """
+        Types are cached until the name changes
+        """
+        classifier = TypeClassifier([("parallel", "\\.$")])
+        classifier.match = Mock(side_effect=classifier.match)
+        self.assertEqual(classifier.classify(1, "project."), "parallel")
+        self.assertEqual(classifier.classify(1, "project."), "parallel")
+        self.assertEqual(classifier.match.call_count, 1)
+        self.assertEqual(classifier.classify(1, "project"), None)
+        self.assertEqual(classifier.classify(1, "project"), None)
+        self.assertEqual(classifier.match.call_count, 2)
+
+    def test_prune(self):
+        """
+        Pruning keeps only the types classified since the last prune
+        """
+        classifier = TypeClassifier([("parallel", "\\.$")])
+        classifier.classify(1, "project.")
+        classifier.classify(2, "project")
+        classifier.prune()
+        self.assertListEqual(sorted(classifier.cache), [1, 2])
+        classifier.classify(2, "project")
+        classifier.prune()
+        self.assertListEqual(sorted(classifier.cache), [2])
+
 
 class TestItems(unittest.TestCase):
     def setUp(self):
@@ -56,9 +181,7 @@ class TestItems(unittest.TestCase):
         self.na.waitfor_label_id = 2345
         self.na.active_label_id = 3456
         self.na.api = Mock()
-        self.na.args = Mock()
-        self.na.args.parallel_suffix = ":"
-        self.na.args.serial_suffix = "."
+        self.na.args = make_args()
 
     @staticmethod
     def make_obj(items):
@@ -373,5 +496,234 @@ class TestItems(unittest.TestCase):
         self.assertListEqual(self.na.api.items.update.call_args_list, calls)
 
 
+class ParallelOnly(NextAction):
+    def get_project_type(self, project_object, parent_type):
+        return 'parallel'
+
+
+class TestShadow(unittest.TestCase):
+    def setUp(self):
+        self.na = NextAction()
+        self.na.next_label_id = 1234
+        self.na.waitfor_label_id = 2345
+        self.na.active_label_id = 3456
+        self.na.api = Mock()
+        self.na.args = make_args()
+        self.na.args.hide_future = 0
+        self.projects = [{"name": "project1.", "indent": 1, "id": 1}]
+        self.items = [
+            {"item_order": 1, "content": "item1:", "indent": 1, "id": 1,
+             "labels": [], "checked": False, "due_date_utc": None,
+             "project_id": 1},
+            {"item_order": 2, "content": "item2", "indent": 2, "id": 2,
+             "labels": [], "checked": False, "due_date_utc": None,
+             "project_id": 1},
+            {"item_order": 3, "content": "item3.", "indent": 1, "id": 3,
+             "labels": [], "checked": False, "due_date_utc": None,
+             "project_id": 1},
+            {"item_order": 4, "content": "item4", "indent": 2, "id": 4,
+             "labels": [], "checked": False, "due_date_utc": None,
+             "project_id": 1},
+            {"item_order": 5, "content": "item5", "indent": 2, "id": 5,
+             "labels": [], "checked": False, "due_date_utc": None,
+             "project_id": 1},
+        ]
+
+    def test_commit_reference(self):
+        """
+        Only the reference result is committed
+        """
+        shadow = ShadowRunner(self.na, ["reference"], 1)
+        shadow.run(self.projects, self.items)
+        calls = [call(2, labels=[1234]), call(1, labels=[3456])]
+        self.assertListEqual(self.na.api.items.update.call_args_list, calls)
+        self.assertListEqual(shadow.mismatches, [])
+        self.assertEqual(shadow.stats["reference"]["clean"], 1)
+        # the snapshot is not modified
+        self.assertListEqual(self.items[1]["labels"], [])
+
+    def test_mismatch(self):
+        """
+        Differing labels are recorded with the item path
+        """
+        with patch.dict("nextaction.ENGINES", parallel=ParallelOnly):
+            shadow = ShadowRunner(self.na, ["parallel"], 1)
+        shadow.run(self.projects, self.items)
+        calls = [call(2, labels=[1234]), call(1, labels=[3456])]
+        self.assertListEqual(self.na.api.items.update.call_args_list, calls)
+        self.assertEqual(len(shadow.mismatches), 2)
+        mismatch = shadow.mismatches[0]
+        self.assertEqual(mismatch.engine, "parallel")
+        self.assertEqual(mismatch.item_id, 3)
+        self.assertEqual(mismatch.path, "project1. / item3.")
+        self.assertListEqual(mismatch.expected, [])
+        self.assertListEqual(mismatch.actual, [3456])
+        mismatch = shadow.mismatches[1]
+        self.assertEqual(mismatch.item_id, 4)
+        self.assertEqual(mismatch.path, "project1. / item3. / item4")
+        self.assertListEqual(mismatch.actual, [1234])
+        self.assertEqual(shadow.stats["parallel"]["clean"], 0)
+
+
+class TestLabels(unittest.TestCase):
+    def setUp(self):
+        self.na = NextAction()
+        self.na.api = Mock()
+        self.na.args = Mock()
+        self.na.args.create_labels = False
+        self.na.update_labels([{"id": 1234, "name": "next_action"},
+                               {"id": 2345, "name": "waitfor"},
+                               {"id": 3456, "name": "active"}])
+
+    def test_index(self):
+        """
+        Label index follows renames and deletions
+        """
+        self.na.update_labels([{"id": 1234, "name": "next"},
+                               {"id": 2345, "name": "waitfor",
+                                "is_deleted": 1}])
+        self.assertDictEqual(self.na.label_ids, {"next": 1234,
+                                                 "active": 3456})
+        self.assertDictEqual(self.na.label_names, {1234: "next",
+                                                   3456: "active"})
+
+    def test_deleted_managed(self):
+        """
+        Deleted managed labels are looked up again
+        """
+        self.na.args.configure_mock(label="next_action", active="active",
+                                    waitfor="waitfor")
+        self.na.next_label_id = 1234
+        self.na.waitfor_label_id = 2345
+        self.na.active_label_id = 3456
+        self.na.update_labels([{"id": 1234, "name": "next_action",
+                                "is_deleted": 1}])
+        self.assertIsNone(self.na.next_label_id)
+        self.assertFalse(self.na.resolve_labels())
+        self.na.api.labels.add.assert_not_called()
+
+        self.na.args.create_labels = True
+        self.na.api.labels.add.return_value = {"id": 4567,
+                                               "name": "next_action"}
+        self.na.api.commit.return_value = {
+            "labels": [{"id": 4567, "name": "next_action"}]}
+        self.assertTrue(self.na.resolve_labels())
+        self.assertEqual(self.na.next_label_id, 4567)
+        self.assertEqual(self.na.active_label_id, 3456)
+
+    def test_missing(self):
+        """
+        Missing labels are reported or created
+        """
+        self.assertEqual(self.na.find_label("next_action"), 1234)
+        self.assertIsNone(self.na.find_label("someday"))
+        self.na.api.labels.add.assert_not_called()
+
+        self.na.args.create_labels = True
+        self.na.api.labels.add.return_value = {"id": 4567, "name": "someday"}
+        self.na.api.commit.return_value = {
+            "labels": [{"id": 4567, "name": "someday"}]}
+        self.assertEqual(self.na.find_label("someday"), 4567)
+        self.na.api.labels.add.assert_called_once_with("someday")
+        self.assertEqual(self.na.label_ids["someday"], 4567)
+
+    def test_reload(self):
+        """
+        Reload switches labels and markers keeping the synced state
+        """
+        self.na.update_labels([{"id": 4567, "name": "next"}])
+        args = dict(api_key="key", label="next_action", active="active",
+                    waitfor="waitfor", debug=False, create_labels=False,
+                    parallel_suffix=".", serial_suffix="_",
+                    parallel_prefix=None, serial_prefix=None,
+                    parallel_regex=None, serial_regex=None,
+                    shadow=None, shadow_cycles=100)
+        self.na.args = argparse.Namespace(**args)
+        self.na.next_label_id = 1234
+        self.na.waitfor_label_id = 2345
+        self.na.active_label_id = 3456
+        self.assertEqual(self.na.get_item_type(Mock(id=1, content="a:")),
+                         None)
+        api = self.na.api
+
+        args.update(label="next", parallel_suffix=":", api_key="other")
+        self.na.read_args = Mock(return_value=argparse.Namespace(**args))
+        self.na.api.items.all.return_value = [
+            {"id": 1, "content": "item1", "labels": [987, 1234]}]
+        self.na.reload_requested = True
+        self.na.reload()
+
+        self.assertFalse(self.na.reload_requested)
+        self.assertIs(self.na.api, api)
+        self.assertEqual(self.na.args.api_key, "key")
+        self.assertEqual(self.na.next_label_id, 4567)
+        self.na.api.items.update.assert_called_once_with(1, labels=[987])
+        self.assertEqual(self.na.get_item_type(Mock(id=1, content="a:")),
+                         "parallel")
+
+    def test_reload_process(self):
+        """
+        Processing after reload labels with the new label only
+        """
+        self.na.update_labels([{"id": 4567, "name": "next"}])
+        args = dict(api_key="key", label="next_action", active="active",
+                    waitfor="waitfor", debug=False, create_labels=False,
+                    parallel_suffix=".", serial_suffix="_",
+                    parallel_prefix=None, serial_prefix=None,
+                    parallel_regex=None, serial_regex=None,
+                    shadow=None, shadow_cycles=100, inbox="parallel",
+                    hide_future=0)
+        self.na.args = argparse.Namespace(**args)
+        self.na.next_label_id = 1234
+        self.na.waitfor_label_id = 2345
+        self.na.active_label_id = 3456
+        items = [{"item_order": 1, "content": "item1", "indent": 1, "id": 1,
+                  "labels": [1234], "checked": False, "due_date_utc": None,
+                  "project_id": 1}]
+        self.na.api.items.all.side_effect = \
+            lambda filt=None: [x for x in items if filt is None or filt(x)]
+        queued = []
+        self.na.api.items.update.side_effect = \
+            lambda item_id, labels: queued.append((item_id, list(labels)))
+
+        args.update(label="next")
+        self.na.read_args = Mock(return_value=argparse.Namespace(**args))
+        self.na.reload()
+        self.na.process([{"name": "project1_", "indent": 1, "id": 1}])
+
+        self.assertListEqual(queued, [(1, []), (1, [4567]),
+                                      (1, [4567, 3456])])
+        self.assertListEqual(items[0]["labels"], [4567, 3456])
+
+    def test_reload_invalid_regex(self):
+        """
+        Reload keeps the configuration and classifier on a bad regex
+        """
+        old_args = self.na.args = make_args()
+        classifier = self.na.classifier
+        args = make_args()
+        args.serial_regex = "("
+        self.na.read_args = Mock(return_value=args)
+        self.na.reload()
+        self.assertIs(self.na.args, old_args)
+        self.assertIs(self.na.classifier, classifier)
+        self.na.api.labels.add.assert_not_called()
+
+    def test_reload_missing(self):
+        """
+        Reload keeps the configuration if a label is missing
+        """
+        old_args = self.na.args
+        self.na.next_label_id = 1234
+        args = make_args()
+        args.configure_mock(label="next", active="active", waitfor="waitfor",
+                            create_labels=False)
+        self.na.read_args = Mock(return_value=args)
+        self.na.reload()
+        self.assertIs(self.na.args, old_args)
+        self.assertEqual(self.na.next_label_id, 1234)
+        self.na.api.items.update.assert_not_called()
+
+
 if __name__ == '__main__':
     unittest.main()